@@ -1,48 +1,86 @@
 #!/usr/bin/env python3
 import argparse
-import asyncio
-import json
 import os
 import sys
 import time
 from pathlib import Path
 from typing import Optional
-from urllib.parse import parse_qs, urlparse
 from uuid import uuid4
 
-try:
-    from miot.client import MIoTClient
-except ModuleNotFoundError:
-    repo_root = Path(__file__).resolve().parents[1]
-    sys.path.insert(0, str(repo_root / "miot_kit"))
-    from miot.client import MIoTClient
+DEFAULT_REDIRECT_URI = "https://mico.api.mijia.tech/login_redirect"
 
 
-DEFAULT_REDIRECT_URI = "https://mico.api.mijia.tech/login_redirect"
+def _expanded_path(value: str) -> Path:
+    return Path(value).expanduser()
+
+
+def _load_client_class():
+    # Deferred so that `--help` and arg errors never pay the miot_kit
+    # import cost (aiohttp, pydantic, zeroconf, ...).
+    try:
+        from miot.client import MIoTClient
+    except ModuleNotFoundError:
+        repo_root = Path(__file__).resolve().parents[1]
+        sys.path.insert(0, str(repo_root / "miot_kit"))
+        from miot.client import MIoTClient
+    return MIoTClient
+
+
+def _unquote_if_needed(value: str) -> str:
+    if "%" in value or "+" in value:
+        from urllib.parse import unquote_plus
+
+        return unquote_plus(value)
+    return value
 
 
 def _parse_code_state(raw: str) -> tuple[Optional[str], Optional[str]]:
     raw = raw.strip()
     if not raw:
         return None, None
+    # Common case: the user pasted just the code ("or code" in the
+    # prompt). No '=' and no scheme means there is nothing to parse.
+    if "=" not in raw and "://" not in raw:
+        return raw, None
     if raw.startswith("http://") or raw.startswith("https://"):
-        parsed = urlparse(raw)
-        qs = parse_qs(parsed.query)
-        code = qs.get("code", [None])[0]
-        state = qs.get("state", [None])[0]
-        return code, state
-    if "code=" in raw:
-        qs = parse_qs(raw)
-        code = qs.get("code", [None])[0]
-        state = qs.get("state", [None])[0]
-        return code, state
-    return raw, None
+        # Keep only the query string; fragments never carry the code.
+        raw = raw.partition("?")[2].partition("#")[0]
+    elif "code=" not in raw:
+        return raw, None
+    # Single-pass scan for the two keys of interest; avoids building the
+    # full dict-of-lists that parse_qs would allocate.
+    code: Optional[str] = None
+    state: Optional[str] = None
+    i = 0
+    n = len(raw)
+    while i < n:
+        amp = raw.find("&", i)
+        end = n if amp < 0 else amp
+        eq = raw.find("=", i, end)
+        if eq > i:
+            key = raw[i:eq]
+            if key == "code":
+                code = _unquote_if_needed(raw[eq + 1 : end])
+            elif key == "state":
+                state = _unquote_if_needed(raw[eq + 1 : end])
+        i = end + 1
+    return code or None, state or None
 
 
 async def _run(args: argparse.Namespace) -> int:
+    import json
+
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+
+    MIoTClient = _load_client_class()
+
     uuid = args.uuid or uuid4().hex
-    token_path = Path(args.token_file).expanduser()
-    token_path.parent.mkdir(parents=True, exist_ok=True)
+    token_path: Path = args.token_file
+    if not token_path.parent.exists():
+        token_path.parent.mkdir(parents=True, exist_ok=True)
 
     client = MIoTClient(
         uuid=uuid,
@@ -52,10 +90,13 @@ async def _run(args: argparse.Namespace) -> int:
     await client.init_async()
     try:
         auth_url = await client.gen_oauth_url_async()
-        print("\nOpen this URL in your browser and finish Xiaomi login:")
-        print(auth_url)
-        print("\nAfter login, copy the final redirect URL and paste it here.")
-        raw = input("Redirect URL (or code): ").strip()
+        prompt = (
+            "\nOpen this URL in your browser and finish Xiaomi login:\n"
+            f"{auth_url}\n"
+            "\nAfter login, copy the final redirect URL and paste it here.\n"
+            "Redirect URL (or code): "
+        )
+        raw = input(prompt).strip()
         code, state = _parse_code_state(raw)
         if not code:
             print("No code found. Aborting.")
@@ -72,11 +113,24 @@ async def _run(args: argparse.Namespace) -> int:
             "oauth_info": oauth_info.model_dump(exclude_none=True),
             "saved_at": int(time.time()),
         }
-        token_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-        try:
-            os.chmod(token_path, 0o600)
-        except OSError:
-            pass
+        if orjson is not None:
+            data = orjson.dumps(payload, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+        if os.name == "nt":
+            # Windows ignores os.open mode bits; keep the plain write.
+            token_path.write_bytes(data)
+        else:
+            # Create with 0o600 directly so the secret never sits
+            # world-readable between write and chmod.
+            fd = os.open(str(token_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                # The open mode only applies on creation; repair the
+                # permissions of a pre-existing token file too.
+                os.fchmod(fd, 0o600)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
 
         print(f"\nSaved token info to: {token_path}")
         print("You can now start the MCP HTTP server with the same token file.")
@@ -89,10 +143,17 @@ def main() -> int:
     parser = argparse.ArgumentParser(description="Xiaomi MIoT OAuth helper")
     parser.add_argument("--cloud-server", default="cn", help="Cloud server region, e.g. cn/sg/us/ru/de/i2")
     parser.add_argument("--redirect-uri", default=DEFAULT_REDIRECT_URI, help="OAuth redirect URI")
-    parser.add_argument("--token-file", default=".cache/miot_oauth.json", help="Where to save OAuth info")
+    parser.add_argument(
+        "--token-file",
+        type=_expanded_path,
+        default=".cache/miot_oauth.json",
+        help="Where to save OAuth info",
+    )
     parser.add_argument("--uuid", default=None, help="Device uuid (auto-generated if omitted)")
     args = parser.parse_args()
 
+    import asyncio
+
     try:
         return asyncio.run(_run(args))
     except KeyboardInterrupt:
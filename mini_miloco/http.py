@@ -1,47 +1,74 @@
 #!/usr/bin/env python3
 import argparse
-import asyncio
-import platform
 import sys
+from pathlib import Path
 
-from .server import run_server
+# sys.platform is a constant set at interpreter start; platform.system()
+# would shell out to uname on every --help invocation.
+_IS_DARWIN = sys.platform == "darwin"
+
+
+def _expanded_path(value: str) -> Path:
+    return Path(value).expanduser()
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(description="MIoT MCP HTTP server (devices/scenes/cameras)")
     parser.add_argument(
         "--token-file",
+        type=_expanded_path,
         default=".cache/miot_oauth.json",
         help="OAuth token file",
     )
     parser.add_argument(
         "--cache-dir",
+        type=_expanded_path,
         default=".cache/miot_cache",
         help="Cache directory for MIoT specs",
     )
     parser.add_argument("--refresh-window", type=int, default=3600, help="Refresh token if expiring within seconds")
     parser.add_argument(
         "--camera-snapshot-dir",
+        type=_expanded_path,
         default=".cache/miot_camera_snapshots",
         help="Directory to write camera snapshots",
     )
     parser.add_argument("--cloud-server", default="cn", help="Cloud server region, e.g. cn/sg/us/ru/de/i2")
     parser.add_argument("--redirect-uri", default="https://mico.api.mijia.tech/login_redirect", help="OAuth redirect URI")
     parser.add_argument("--uuid", default=None, help="Device uuid (auto-generated if omitted)")
-    parser.add_argument(
-        "--disable-lan",
+    lan_group = parser.add_mutually_exclusive_group()
+    lan_group.add_argument(
+        "--enable-lan",
+        dest="enable_lan",
         action="store_true",
-        default=platform.system() == "Darwin",
+        default=None,
+        help="Force enable LAN discovery",
+    )
+    lan_group.add_argument(
+        "--disable-lan",
+        dest="enable_lan",
+        action="store_false",
         help="Disable LAN discovery (default on macOS)",
     )
-    parser.add_argument("--enable-lan", action="store_true", help="Force enable LAN discovery")
     parser.add_argument("--host", default="127.0.0.1", help="HTTP listen host")
     parser.add_argument("--port", type=int, default=2324, help="HTTP listen port")
     parser.add_argument("--path", default="/mcp", help="HTTP base path")
     args = parser.parse_args()
-    enable_lan = not args.disable_lan
-    if args.enable_lan:
-        enable_lan = True
+    enable_lan = args.enable_lan if args.enable_lan is not None else not _IS_DARWIN
+
+    # Deferred so --help/arg errors don't pay the server import graph
+    # (fastmcp, starlette, miot_kit).
+    import asyncio
+
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        # C-level event loop; noticeably lower latency on the HTTP path.
+        uvloop.install()
+
+    from .server import run_server
 
     try:
         return asyncio.run(
@@ -1,43 +1,104 @@
+import array
 import asyncio
-import base64
-from collections import deque
+import binascii
+import contextlib
+from dataclasses import dataclass
+import html
 import json
+import os
 import shutil
-import subprocess
-import tempfile
 import time
 from pathlib import Path
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qsl
 from uuid import uuid4
 
-from fastmcp import FastMCP
-from fastmcp.exceptions import ToolError
-from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
 
 from . import __version__
 
 DEFAULT_REDIRECT_URI = "https://mico.api.mijia.tech/login_redirect"
 
+# Camera topology changes rarely; keep the get_cameras_async result this
+# long before hitting the cloud again.
+CAMERAS_CACHE_TTL = 30.0
+
+# Never refresh the token more often than this, whatever the expiry
+# window claims — guards against clock skew turning into a refresh storm.
+MIN_REFRESH_INTERVAL = 60
+
+# Reuse the OAuth helper client across /auth page hits for this long
+# before rebuilding it; a pending login flow rarely outlives this.
+AUTH_CLIENT_TTL = 600.0
+
+# Static HTML rendered once at import; the routes only concatenate the
+# dynamic auth URL in between.
+_ROOT_HTML = (
+    b"<html><body>"
+    b"<h3>Mini Miloco MCP HTTP</h3>"
+    b"<ul>"
+    b"<li><a href='/health'>/health</a></li>"
+    b"<li><a href='/version'>/version</a></li>"
+    b"<li><a href='/auth'>/auth</a></li>"
+    b"</ul>"
+    b"</body></html>"
+)
+
+_AUTH_HTML_PREFIX = (
+    "<html><body>"
+    "<h3>Mini Miloco Authorization</h3>"
+    "<p>1) Open this URL and complete login:</p>"
+    '<p><a href="'
+)
+_AUTH_HTML_MID = '" target="_blank">'
+_AUTH_HTML_SUFFIX = (
+    "</a></p>"
+    "<p>2) Paste the final redirect URL below:</p>"
+    '<form method="get" action="/auth/callback">'
+    '<input type="text" name="url" style="width: 90%;" />'
+    '<button type="submit">Submit</button>'
+    "</form>"
+    "</body></html>"
+)
+
 
 def _parse_code_state(raw: str) -> tuple[str | None, str | None]:
     raw = raw.strip()
     if not raw:
         return None, None
-    if raw.startswith("http://") or raw.startswith("https://"):
-        parsed = urlparse(raw)
-        qs = parse_qs(parsed.query)
-        code = qs.get("code", [None])[0]
-        state = qs.get("state", [None])[0]
-        return code, state
-    if "code=" in raw:
-        qs = parse_qs(raw)
-        code = qs.get("code", [None])[0]
-        state = qs.get("state", [None])[0]
-        return code, state
-    return raw, None
-
+    # Single dispatch: a URL contributes its query string, a bare query
+    # string carrying code= is used as-is, anything else is treated as a
+    # raw code — '=' alone isn't enough, since pasted codes can contain
+    # it (base64 padding).
+    if "://" in raw:
+        query = raw.partition("?")[2]
+    elif "code=" in raw:
+        query = raw
+    else:
+        return raw, None
+    # parse_qsl yields flat pairs, skipping parse_qs's list-per-key dict.
+    params = dict(parse_qsl(query.partition("#")[0], keep_blank_values=True))
+    return params.get("code") or None, params.get("state") or None
+
+
+def _miot_imports():
+    # Deferred: miot_kit drags in aiohttp, pydantic, zeroconf, etc., so
+    # `import mini_miloco.server` stays cheap and the cost is paid once
+    # when the server (or auth flow) actually starts.
+    try:
+        import miot.client  # noqa: F401
+    except ModuleNotFoundError:
+        repo_root = Path(__file__).resolve().parents[1]
+        import sys
 
-try:
+        sys.path.insert(0, str(repo_root / "miot_kit"))
     from miot.client import MIoTClient
     from miot.cloud import MIoTOAuth2Client
     from miot.mcp import (
@@ -46,14 +107,10 @@ try:
         MIoTManualSceneMcp,
         MIoTManualSceneMcpInterface,
     )
-except ModuleNotFoundError:
-    repo_root = Path(__file__).resolve().parents[1]
-    import sys
 
-    sys.path.insert(0, str(repo_root / "miot_kit"))
-    from miot.client import MIoTClient
-    from miot.cloud import MIoTOAuth2Client
-    from miot.mcp import (
+    return (
+        MIoTClient,
+        MIoTOAuth2Client,
         MIoTDeviceMcp,
         MIoTDeviceMcpInterface,
         MIoTManualSceneMcp,
@@ -61,13 +118,150 @@ except ModuleNotFoundError:
     )
 
 
+# Starting slot size for the frame ring; slots grow on demand for
+# larger JPEGs and are then reused.
+_INITIAL_FRAME_BUF = 512 * 1024
+
+
+def _new_frame_ring(buffer_size: int) -> dict:
+    # Fixed arena of reusable bytearray slots plus parallel len/ts
+    # arrays: steady-state frame ingest allocates nothing.
+    return {
+        "bufs": [bytearray(_INITIAL_FRAME_BUF) for _ in range(buffer_size)],
+        "lens": array.array("i", [0] * buffer_size),
+        "ts": array.array("q", [0] * buffer_size),
+        "head": 0,
+        "size": buffer_size,
+    }
+
+
+def _ring_append(ring: dict, data: bytes, ts: int) -> None:
+    slot = ring["head"] % ring["size"]
+    buf = ring["bufs"][slot]
+    n = len(data)
+    if n > len(buf):
+        buf = bytearray(n)
+        ring["bufs"][slot] = buf
+    buf[:n] = data
+    ring["lens"][slot] = n
+    ring["ts"][slot] = ts
+    ring["head"] += 1
+
+
+def _ring_latest(ring: dict) -> tuple[bytes, int] | None:
+    # Copies the frame out so the slot can be overwritten while the
+    # caller encodes/writes it off the loop.
+    if ring["head"] == 0:
+        return None
+    slot = (ring["head"] - 1) % ring["size"]
+    return bytes(memoryview(ring["bufs"][slot])[: ring["lens"][slot]]), ring["ts"][slot]
+
+
+def _ring_last_n(ring: dict, count: int) -> list[tuple[bytes, int]]:
+    avail = min(ring["head"], ring["size"], count)
+    out = []
+    for idx in range(ring["head"] - avail, ring["head"]):
+        slot = idx % ring["size"]
+        out.append((bytes(memoryview(ring["bufs"][slot])[: ring["lens"][slot]]), ring["ts"][slot]))
+    return out
+
+
+# Frames above this size get their base64 encode pushed off the loop;
+# below it the thread handoff costs more than the encode itself.
+_B64_OFFLOAD_BYTES = 256 * 1024
+
+
+def _b64(data: bytes) -> str:
+    # b2a_base64 is the C fast path under base64.b64encode; the output is
+    # guaranteed ASCII so skip utf-8 validation on decode.
+    return binascii.b2a_base64(data, newline=False).decode("ascii")
+
+
+async def _b64_async(data: bytes) -> str:
+    if len(data) > _B64_OFFLOAD_BYTES:
+        return await asyncio.to_thread(_b64, data)
+    return _b64(data)
+
+
+async def _write_jpg(path: Path, data: bytes) -> None:
+    # Frames are hundreds of KB; keep the blocking write off the loop.
+    # aiofiles reuses its own worker threads instead of paying a
+    # to_thread handoff per snapshot.
+    if aiofiles is not None:
+        async with aiofiles.open(path, "wb") as f:
+            await f.write(data)
+        return
+    await asyncio.to_thread(path.write_bytes, data)
+
+
+def _write_jpgs_batch(dir_path: Path, pairs: list[tuple[str, bytes]]) -> None:
+    # Blocking; run via asyncio.to_thread. With dir_fd support a single
+    # directory handle serves every open, skipping the per-file path walk.
+    if os.open not in os.supports_dir_fd:
+        for name, data in pairs:
+            (dir_path / name).write_bytes(data)
+        return
+    dfd = os.open(str(dir_path), os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        for name, data in pairs:
+            fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dfd)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+    finally:
+        os.close(dfd)
+
+
+def _atomic_write_json(path: Path, payload: dict) -> None:
+    # Write-then-rename so a crash mid-write never corrupts the token.
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    # Compact form: the file is machine-consumed and the indented C
+    # encoder path is measurably slower and ~30% larger.
+    if orjson is not None:
+        data = orjson.dumps(payload)
+    else:
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        # Flush to stable storage before the rename; otherwise a power
+        # loss can leave the new name pointing at a zero-length file.
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        path.chmod(0o600)
+    except OSError:
+        pass
+
+
 def _load_token_file(path: Path) -> dict:
-    payload = json.loads(path.read_text(encoding="utf-8"))
+    if orjson is not None:
+        payload = orjson.loads(path.read_bytes())
+    else:
+        payload = json.loads(path.read_text(encoding="utf-8"))
     if "oauth_info" not in payload:
         raise ValueError("token file missing oauth_info")
     return payload
 
 
+@dataclass(slots=True)
+class _PendingAuth:
+    """In-flight /auth flow state, mutated in place by the auth routes."""
+
+    url: str | None = None
+    state: str | None = None
+    uuid: str | None = None
+    redirect: str | None = None
+    cloud: str | None = None
+
+    def reset(self) -> None:
+        self.url = None
+        self.state = None
+        self.uuid = None
+        self.redirect = None
+        self.cloud = None
+
+
 def _needs_refresh(oauth_info: dict, refresh_window_seconds: int) -> bool:
     expires_ts = oauth_info.get("expires_ts")
     if not isinstance(expires_ts, int):
@@ -83,6 +277,7 @@ async def _interactive_auth(
     uuid: str | None,
     enable_lan: bool,
 ) -> dict:
+    MIoTOAuth2Client = _miot_imports()[1]
     device_uuid = uuid or uuid4().hex
     oauth_client = MIoTOAuth2Client(
         redirect_uri=redirect_uri,
@@ -111,11 +306,7 @@ async def _interactive_auth(
             "saved_at": int(time.time()),
         }
         token_path.parent.mkdir(parents=True, exist_ok=True)
-        token_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-        try:
-            token_path.chmod(0o600)
-        except OSError:
-            pass
+        _atomic_write_json(token_path, payload)
         return payload
     finally:
         await oauth_client.deinit_async()
@@ -123,10 +314,10 @@ async def _interactive_auth(
 
 async def run_server(
     *,
-    token_file: str,
-    cache_dir: str,
+    token_file: str | Path,
+    cache_dir: str | Path,
     refresh_window: int,
-    camera_snapshot_dir: str,
+    camera_snapshot_dir: str | Path,
     host: str,
     port: int,
     path: str,
@@ -138,12 +329,24 @@ async def run_server(
     uuid: str | None,
     enable_lan: bool,
 ) -> int:
+    from fastmcp import FastMCP
+    from fastmcp.exceptions import ToolError
+    from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse
+
+    (
+        MIoTClient,
+        MIoTOAuth2Client,
+        MIoTDeviceMcp,
+        MIoTDeviceMcpInterface,
+        MIoTManualSceneMcp,
+        MIoTManualSceneMcpInterface,
+    ) = _miot_imports()
+
+    # Resolved once; record_camera_clip just checks the cached result.
+    ffmpeg_path = await asyncio.to_thread(shutil.which, "ffmpeg")
+
     token_path = Path(token_file).expanduser()
-    pending_auth_url: str | None = None
-    pending_auth_state: str | None = None
-    pending_auth_uuid: str | None = None
-    pending_auth_redirect: str | None = None
-    pending_auth_cloud: str | None = None
+    pending_auth = _PendingAuth()
     payload: dict | None = _load_token_file(token_path) if token_path.exists() else None
     if payload is None:
         print(f"Token file not found: {token_path}")
@@ -152,13 +355,29 @@ async def run_server(
     cache_path = Path(cache_dir).expanduser()
     cache_path.mkdir(parents=True, exist_ok=True)
 
+    # Expanded and created once; every snapshot/record path closes over
+    # this instead of re-expanding and re-stat'ing per call.
+    snapshot_dir = Path(camera_snapshot_dir).expanduser()
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+
     client: MIoTClient | None = None
     miot_devices_mcp: MIoTDeviceMcp | None = None
     miot_scenes_mcp: MIoTManualSceneMcp | None = None
     auth_lock = asyncio.Lock()
+    refresh_task: asyncio.Task | None = None
+    token_refresher_task: asyncio.Task | None = None
+    auto_start_task: asyncio.Task | None = None
+    cameras_cache: tuple[float, dict] | None = None
+    cameras_lock = asyncio.Lock()
     camera_cache: dict[tuple[str, int], dict] = {}
-    camera_cache_events: dict[tuple[str, int], asyncio.Event] = {}
+    camera_cache_conds: dict[tuple[str, int], asyncio.Condition] = {}
     camera_instances: dict[str, dict] = {}
+    camera_instances_lock = asyncio.Lock()
+    channel_locks: dict[tuple[str, int], asyncio.Lock] = {}
+    auth_client: MIoTOAuth2Client | None = None
+    auth_client_cfg: tuple[str, str, str] | None = None
+    auth_client_created_at = 0.0
+    resolved_auth: tuple[str, str, str] | None = None
     auth_required_message = (
         "Authorization required.\n"
         "Steps:\n"
@@ -167,18 +386,86 @@ async def run_server(
         "3) Retry the request\n"
     )
 
+    async def _do_refresh() -> None:
+        nonlocal payload, client, miot_devices_mcp, miot_scenes_mcp, cameras_cache, resolved_auth
+        try:
+            old_info = payload["oauth_info"]
+            new_info = await client.refresh_access_token_async(refresh_token=old_info["refresh_token"])
+            new_dump = new_info.model_dump(exclude_none=True)
+            payload["oauth_info"] = new_dump
+            payload["saved_at"] = int(time.time())
+            if new_dump.get("access_token") != old_info.get("access_token") or new_dump.get(
+                "refresh_token"
+            ) != old_info.get("refresh_token"):
+                await asyncio.to_thread(_atomic_write_json, token_path, payload)
+        except Exception:
+            # force reauth
+            payload = None
+            resolved_auth = None
+            cameras_cache = None
+            if client:
+                await client.deinit_async()
+            client = None
+            miot_devices_mcp = None
+            miot_scenes_mcp = None
+            raise ToolError(auth_required_message)
+
+    async def _refresh_loop() -> None:
+        # Proactive refresh: wake shortly before the token enters the
+        # refresh window so tool calls almost never refresh inline.
+        nonlocal refresh_task
+        while True:
+            if payload is None or client is None:
+                return
+            expires_ts = payload["oauth_info"].get("expires_ts")
+            if not isinstance(expires_ts, int):
+                return
+            # No floor here: a token already inside the refresh window
+            # (or expired) at startup must be renewed immediately, not
+            # after a grace period tool calls would spend failing.
+            await asyncio.sleep(max(0, expires_ts - int(time.time()) - refresh_window))
+            if payload is None or client is None:
+                return
+            if time.time() - payload.get("saved_at", 0) < MIN_REFRESH_INTERVAL:
+                # Refreshed moments ago (e.g. by the inline fallback);
+                # wait out the rate limit instead of spinning on a token
+                # whose lifetime is shorter than the refresh window.
+                await asyncio.sleep(MIN_REFRESH_INTERVAL)
+                continue
+            if refresh_task is None or refresh_task.done():
+                refresh_task = asyncio.create_task(_do_refresh())
+            try:
+                await asyncio.shield(refresh_task)
+            except ToolError:
+                # Re-auth required; the next tool call surfaces it.
+                return
+
     async def _ensure_client() -> MIoTClient:
-        nonlocal payload, client, miot_devices_mcp, miot_scenes_mcp
+        nonlocal payload, client, miot_devices_mcp, miot_scenes_mcp, cameras_cache, refresh_task
+        nonlocal token_refresher_task
+        # Lock-free fast path: fully initialized and the token is not
+        # close to expiry. Only init/refresh/reauth take the lock.
+        if (
+            client is not None
+            and payload is not None
+            and not _needs_refresh(payload["oauth_info"], refresh_window)
+        ):
+            return client
         async with auth_lock:
-            if not token_path.exists():
-                payload = None
-                raise ToolError(auth_required_message)
-
+            # The in-memory payload is authoritative once loaded; it is
+            # only reset to None on refresh failure (forcing re-auth), so
+            # don't re-stat or re-parse the file on every refresh pass.
             if payload is None:
+                if not token_path.exists():
+                    raise ToolError(auth_required_message)
                 payload = _load_token_file(token_path)
 
             if client is None:
-                client = MIoTClient(
+                # Build and init into locals; the client nonlocal is the
+                # fast path's readiness flag, so publishing it before
+                # init_async completes would hand concurrent callers a
+                # half-initialized client.
+                new_client = MIoTClient(
                     uuid=payload["uuid"],
                     redirect_uri=payload["redirect_uri"],
                     cloud_server=payload.get("cloud_server", "cn"),
@@ -186,55 +473,93 @@ async def run_server(
                     cache_path=str(cache_path),
                     enable_lan=enable_lan,
                 )
-                await client.init_async()
-                miot_devices_mcp = MIoTDeviceMcp(
-                    interface=MIoTDeviceMcpInterface(
-                        translate_async=client.i18n.translate_async,
-                        get_homes_async=client.get_homes_async,
-                        get_devices_async=client.get_devices_async,
-                        get_prop_async=client.http_client.get_prop_async,
-                        set_prop_async=client.http_client.set_prop_async,
-                        action_async=client.http_client.action_async,
-                    ),
-                    spec_parser=client.spec_parser,
-                )
-                miot_scenes_mcp = MIoTManualSceneMcp(
-                    interface=MIoTManualSceneMcpInterface(
-                        translate_async=client.i18n.translate_async,
-                        get_manual_scenes_async=client.get_manual_scenes_async,
-                        trigger_manual_scene_async=client.run_manual_scene_async,
-                        send_app_notify_async=client.send_app_notify_once_async,
-                    )
-                )
-                await miot_devices_mcp.init_async()
-                await miot_scenes_mcp.init_async()
-
-            if _needs_refresh(payload["oauth_info"], refresh_window):
                 try:
-                    new_info = await client.refresh_access_token_async(
-                        refresh_token=payload["oauth_info"]["refresh_token"]
+                    await new_client.init_async()
+                    devices_mcp = MIoTDeviceMcp(
+                        interface=MIoTDeviceMcpInterface(
+                            translate_async=new_client.i18n.translate_async,
+                            get_homes_async=new_client.get_homes_async,
+                            get_devices_async=new_client.get_devices_async,
+                            get_prop_async=new_client.http_client.get_prop_async,
+                            set_prop_async=new_client.http_client.set_prop_async,
+                            action_async=new_client.http_client.action_async,
+                        ),
+                        spec_parser=new_client.spec_parser,
                     )
-                    payload["oauth_info"] = new_info.model_dump(exclude_none=True)
-                    payload["saved_at"] = int(time.time())
-                    token_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+                    scenes_mcp = MIoTManualSceneMcp(
+                        interface=MIoTManualSceneMcpInterface(
+                            translate_async=new_client.i18n.translate_async,
+                            get_manual_scenes_async=new_client.get_manual_scenes_async,
+                            trigger_manual_scene_async=new_client.run_manual_scene_async,
+                            send_app_notify_async=new_client.send_app_notify_once_async,
+                        )
+                    )
+                    # The two inits are independent; overlap their
+                    # round-trips.
+                    await asyncio.gather(devices_mcp.init_async(), scenes_mcp.init_async())
                 except Exception:
-                    # force reauth
-                    payload = None
-                    if client:
-                        await client.deinit_async()
-                    client = None
-                    miot_devices_mcp = None
-                    miot_scenes_mcp = None
-                    raise ToolError(auth_required_message)
-
-            return client
+                    with contextlib.suppress(Exception):
+                        await new_client.deinit_async()
+                    raise
+                client = new_client
+                miot_devices_mcp = devices_mcp
+                miot_scenes_mcp = scenes_mcp
+                if token_refresher_task is None or token_refresher_task.done():
+                    token_refresher_task = asyncio.create_task(_refresh_loop())
+
+            # Inline refresh is only the fallback for a dead refresher
+            # task (or one that never started); normally the background
+            # loop has already renewed the token before we get here.
+            pending_refresh: asyncio.Task | None = None
+            if _needs_refresh(payload["oauth_info"], refresh_window) and (
+                token_refresher_task is None or token_refresher_task.done()
+            ):
+                if time.time() - payload.get("saved_at", 0) < MIN_REFRESH_INTERVAL:
+                    # Refreshed moments ago; don't hammer the endpoint.
+                    return client
+                # One in-flight refresh shared by all callers; a failure
+                # invalidates the client for everyone at once.
+                if refresh_task is None or refresh_task.done():
+                    refresh_task = asyncio.create_task(_do_refresh())
+                pending_refresh = refresh_task
+            client_ready = client
+
+        # Await the refresh outside auth_lock so waiters don't also
+        # head-of-line block unrelated init/reauth work on the lock.
+        if pending_refresh is not None:
+            await asyncio.shield(pending_refresh)
+        return client_ready
+
+    async def _get_cameras(client_ready: MIoTClient, ttl: float = CAMERAS_CACHE_TTL) -> dict:
+        nonlocal cameras_cache
+        if cameras_cache is not None and time.time() - cameras_cache[0] < ttl:
+            return cameras_cache[1]
+        async with cameras_lock:
+            # Re-check under the lock so concurrent misses coalesce into
+            # one cloud round-trip.
+            if cameras_cache is not None and time.time() - cameras_cache[0] < ttl:
+                return cameras_cache[1]
+            cameras = await client_ready.get_cameras_async()
+            cameras_cache = (time.time(), cameras)
+            return cameras
 
     async def _get_camera_info(client_ready: MIoTClient, did: str):
-        cameras = await client_ready.get_cameras_async()
+        cameras = await _get_cameras(client_ready)
         if did not in cameras:
             raise ToolError(f"camera not found: {did}")
         return cameras[did]
 
+    async def _wait_for_frame(cache: dict, cond: asyncio.Condition, timeout: float) -> None:
+        # Wait for the frame sequence number to advance past what we have
+        # already seen; no set()/clear() flicker, no missed wakeups.
+        seen = cache["seq"]
+        cache["waiters"] += 1
+        try:
+            async with cond:
+                await asyncio.wait_for(cond.wait_for(lambda: cache["seq"] != seen), timeout=timeout)
+        finally:
+            cache["waiters"] -= 1
+
     async def _get_or_create_camera_instance(
         *,
         client_ready: MIoTClient,
@@ -244,16 +569,21 @@ async def run_server(
     ):
         state = camera_instances.get(camera_info.did)
         if state is None:
-            instance = await client_ready.create_camera_instance_async(camera_info=camera_info)
-            state = {
-                "instance": instance,
-                "started": False,
-                "pin_code": pin_code,
-                "channels": set(),
-                "reg_ids": {},
-                "lock": asyncio.Lock(),
-            }
-            camera_instances[camera_info.did] = state
+            # Serialize creation so concurrent starts for the same camera
+            # don't each build (and leak) an instance.
+            async with camera_instances_lock:
+                state = camera_instances.get(camera_info.did)
+                if state is None:
+                    instance = await client_ready.create_camera_instance_async(camera_info=camera_info)
+                    state = {
+                        "instance": instance,
+                        "started": False,
+                        "pin_code": pin_code,
+                        "channels": set(),
+                        "reg_ids": {},
+                        "lock": asyncio.Lock(),
+                    }
+                    camera_instances[camera_info.did] = state
 
         if pin_code and state.get("pin_code") and pin_code != state.get("pin_code"):
             raise ToolError("pin_code mismatch for cached camera instance")
@@ -281,7 +611,7 @@ async def run_server(
 
         async def list_cameras() -> dict:
             client_ready = await _ensure_client()
-            cameras = await client_ready.get_cameras_async()
+            cameras = await _get_cameras(client_ready)
             return {
                 did: {
                     "did": info.did,
@@ -300,23 +630,29 @@ async def run_server(
             return_base64: bool = False,
             pin_code: str | None = None,
         ) -> dict:
+            # Cheap precondition checks before any auth/RPC round-trip.
+            if channel < 0:
+                raise ToolError(f"invalid channel: {channel}")
+            if timeout <= 0:
+                raise ToolError("timeout must be positive")
+
             client_ready = await _ensure_client()
             camera_info = await _get_camera_info(client_ready, did)
-            if channel < 0 or channel >= (camera_info.channel_count or 1):
+            if channel >= (camera_info.channel_count or 1):
                 raise ToolError(f"invalid channel: {channel}")
 
             cache_key = (did, channel)
-            if cache_key in camera_cache:
-                cache = camera_cache[cache_key]
-                event = camera_cache_events[cache_key]
-                if not cache["frames"]:
+            if (cache := camera_cache.get(cache_key)) is not None:
+                cond = camera_cache_conds[cache_key]
+                if cache["ring"]["head"] == 0:
                     try:
-                        await asyncio.wait_for(event.wait(), timeout=timeout)
+                        await _wait_for_frame(cache, cond, timeout)
                     except asyncio.TimeoutError as exc:
                         raise ToolError(f"snapshot timeout after {timeout}s") from exc
-                if not cache["frames"]:
+                latest = _ring_latest(cache["ring"])
+                if latest is None:
                     raise ToolError("snapshot cache empty")
-                data, ts, _ = cache["frames"][-1]
+                data, ts = latest
             else:
                 state = await _get_or_create_camera_instance(
                     client_ready=client_ready,
@@ -350,13 +686,11 @@ async def run_server(
                     "did": did,
                     "channel": channel,
                     "timestamp": ts,
-                    "base64": base64.b64encode(data).decode("utf-8"),
+                    "base64": await _b64_async(data),
                 }
 
-            snapshot_dir = Path(camera_snapshot_dir).expanduser()
-            snapshot_dir.mkdir(parents=True, exist_ok=True)
             file_path = snapshot_dir / f"camera_{did}_{channel}_{ts}.jpg"
-            file_path.write_bytes(data)
+            await _write_jpg(file_path, data)
             return {
                 "did": did,
                 "channel": channel,
@@ -375,10 +709,12 @@ async def run_server(
                 raise ToolError("duration must be positive")
             if fps <= 0:
                 raise ToolError("fps must be positive")
+            if channel < 0:
+                raise ToolError(f"invalid channel: {channel}")
 
             client_ready = await _ensure_client()
             camera_info = await _get_camera_info(client_ready, did)
-            if channel < 0 or channel >= (camera_info.channel_count or 1):
+            if channel >= (camera_info.channel_count or 1):
                 raise ToolError(f"invalid channel: {channel}")
 
             cache_key = (did, channel)
@@ -393,67 +729,78 @@ async def run_server(
                 await instance.start_async(enable_reconnect=True, pin_code=pin_code)
                 state["started"] = True
 
-            snapshot_dir = Path(camera_snapshot_dir).expanduser()
-            snapshot_dir.mkdir(parents=True, exist_ok=True)
-            jpg_dir = Path(
-                tempfile.mkdtemp(prefix=f"clip_{did}_{channel}_", dir=str(snapshot_dir))
-            )
-            frame_count = max(1, int(duration * fps))
-            frame_futures: list[asyncio.Future] = []
+            out_path = snapshot_dir / f"clip_{did}_{channel}_{int(time.time())}.mp4"
+
+            if ffmpeg_path is None:
+                raise ToolError("ffmpeg is not available. Install imageio-ffmpeg or ffmpeg.")
 
-            loop = asyncio.get_running_loop()
-            for _ in range(frame_count):
-                frame_futures.append(loop.create_future())
+            frame_count = max(1, int(duration * fps))
+            # Bound the queue to ~2s of frames; on overflow drop the
+            # oldest so the clip tracks the live feed instead of stalling
+            # behind a slow encoder.
+            frames: asyncio.Queue[tuple[bytes, int]] = asyncio.Queue(maxsize=max(fps * 2, 4))
 
             async def _on_jpg(_did: str, data: bytes, ts: int, _channel: int):
-                for fut in frame_futures:
-                    if not fut.done():
-                        fut.set_result((data, ts))
-                        break
+                if frames.full():
+                    frames.get_nowait()
+                frames.put_nowait((data, ts))
+
+            # Stream JPEGs straight into ffmpeg's stdin; no temp dir, no
+            # second read of every frame through the glob demuxer.
+            proc = await asyncio.create_subprocess_exec(
+                ffmpeg_path,
+                "-y",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                str(fps),
+                "-i",
+                "-",
+                "-vcodec",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                str(out_path),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            # Drain stderr concurrently: ffmpeg streams progress there
+            # and blocks once the pipe fills, which would wedge the
+            # stdin writes below on a multi-minute clip.
+            stderr_task = asyncio.create_task(proc.stderr.read())
 
             reg_id = await instance.register_decode_jpg_async(callback=_on_jpg, channel=channel, multi_reg=True)
             try:
-                for idx, fut in enumerate(frame_futures):
-                    data, ts = await asyncio.wait_for(fut, timeout=duration + 5)
-                    (jpg_dir / f"frame_{idx:05d}_{ts}.jpg").write_bytes(data)
+                for _ in range(frame_count):
+                    data, _ts = await asyncio.wait_for(frames.get(), timeout=duration + 5)
+                    proc.stdin.write(data)
+                    # Same deadline as the queue get: a stalled encoder
+                    # must surface as ToolError, not hang the tool.
+                    await asyncio.wait_for(proc.stdin.drain(), timeout=duration + 5)
             except asyncio.TimeoutError as exc:
+                proc.kill()
+                await proc.wait()
+                stderr_task.cancel()
                 raise ToolError("record timeout") from exc
+            except (BrokenPipeError, ConnectionResetError) as exc:
+                # ffmpeg died mid-stream (bad output path, encoder
+                # error); reap it and surface its stderr.
+                await proc.wait()
+                msg = (await stderr_task).decode("utf-8", errors="ignore")
+                raise ToolError(f"ffmpeg failed: {msg}") from exc
             finally:
                 await instance.unregister_decode_jpg_async(channel=channel, reg_id=reg_id)
                 if cache_key not in camera_cache and not state["channels"]:
                     await instance.stop_async()
                     state["started"] = False
 
-            out_path = snapshot_dir / f"clip_{did}_{channel}_{int(time.time())}.mp4"
-
-            if shutil.which("ffmpeg") is None:
-                raise ToolError("ffmpeg is not available. Install imageio-ffmpeg or ffmpeg.")
-
-            input_pattern = str(jpg_dir / "frame_*.jpg")
-            if not list(jpg_dir.glob("frame_*.jpg")):
-                raise ToolError("no frames captured for recording")
-            cmd = [
-                "ffmpeg",
-                "-y",
-                "-r",
-                str(fps),
-                "-pattern_type",
-                "glob",
-                "-i",
-                input_pattern,
-                "-vcodec",
-                "libx264",
-                "-pix_fmt",
-                "yuv420p",
-                str(out_path),
-            ]
-            try:
-                subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            except subprocess.CalledProcessError as exc:
-                msg = exc.stderr.decode("utf-8", errors="ignore")
-                raise ToolError(f"ffmpeg failed: {msg}\nframes kept at: {jpg_dir}") from exc
-            else:
-                shutil.rmtree(jpg_dir, ignore_errors=True)
+            proc.stdin.close()
+            await proc.wait()
+            stderr = await stderr_task
+            if proc.returncode != 0:
+                msg = stderr.decode("utf-8", errors="ignore")
+                raise ToolError(f"ffmpeg failed: {msg}")
 
             return {
                 "did": did,
@@ -560,10 +907,15 @@ async def run_server(
             channel: int,
             pin_code: str | None,
             buffer_size: int,
+            camera_info=None,
         ) -> dict:
+            if channel < 0:
+                raise ToolError(f"invalid channel: {channel}")
+
             client_ready = await _ensure_client()
-            camera_info = await _get_camera_info(client_ready, did)
-            if channel < 0 or channel >= (camera_info.channel_count or 1):
+            if camera_info is None:
+                camera_info = await _get_camera_info(client_ready, did)
+            if channel >= (camera_info.channel_count or 1):
                 raise ToolError(f"invalid channel: {channel}")
 
             state = await _get_or_create_camera_instance(
@@ -575,29 +927,39 @@ async def run_server(
             instance = state["instance"]
 
             cache_key = (did, channel)
-            if cache_key not in camera_cache:
-                camera_cache[cache_key] = {
-                    "frames": deque(maxlen=buffer_size),
-                    "updated_at": None,
-                }
-                camera_cache_events[cache_key] = asyncio.Event()
-
-                async def _on_jpg(_did: str, data: bytes, ts: int, _channel: int):
-                    cache = camera_cache.get(cache_key)
-                    if cache is None:
-                        return
-                    cache["frames"].append((data, ts, time.time()))
-                    cache["updated_at"] = time.time()
-                    camera_cache_events[cache_key].set()
-                    camera_cache_events[cache_key].clear()
-
-                reg_id = await instance.register_decode_jpg_async(
-                    callback=_on_jpg,
-                    channel=channel,
-                    multi_reg=True,
-                )
-                state["channels"].add(channel)
-                state["reg_ids"][channel] = reg_id
+            # Per-channel lock: concurrent starts for the same channel
+            # serialize, different cameras/channels stay parallel.
+            async with channel_locks.setdefault(cache_key, asyncio.Lock()):
+                if cache_key not in camera_cache:
+                    cache = {
+                        "ring": _new_frame_ring(buffer_size),
+                        "updated_at": None,
+                        "seq": 0,
+                        "waiters": 0,
+                    }
+                    cond = asyncio.Condition()
+                    camera_cache[cache_key] = cache
+                    camera_cache_conds[cache_key] = cond
+
+                    async def _on_jpg(_did: str, data: bytes, ts: int, _channel: int):
+                        # cache/cond are captured directly; the dict probe is
+                        # only there to detect stop_camera_cache.
+                        if cache_key not in camera_cache:
+                            return
+                        _ring_append(cache["ring"], data, ts)
+                        cache["updated_at"] = time.time()
+                        cache["seq"] += 1
+                        if cache["waiters"]:
+                            async with cond:
+                                cond.notify_all()
+
+                    reg_id = await instance.register_decode_jpg_async(
+                        callback=_on_jpg,
+                        channel=channel,
+                        multi_reg=True,
+                    )
+                    state["channels"].add(channel)
+                    state["reg_ids"][channel] = reg_id
 
             return {
                 "did": did,
@@ -632,47 +994,58 @@ async def run_server(
                 raise ToolError("invalid channel")
 
             client_ready = await _ensure_client()
-            cameras = await client_ready.get_cameras_async()
-            results = {}
-            for did, camera_info in cameras.items():
-                max_channels = camera_info.channel_count or 1
-                channels = range(max_channels) if all_channels else [channel]
-                per_camera = []
-                for ch in channels:
-                    if ch < 0 or ch >= max_channels:
-                        continue
+            cameras = await _get_cameras(client_ready)
+            sem = asyncio.Semaphore(8)
+
+            async def _guarded_start(did: str, ch: int, camera_info) -> tuple[str, dict]:
+                async with sem:
                     try:
                         res = await _start_camera_cache(
                             did=did,
                             channel=ch,
                             pin_code=pin_code,
                             buffer_size=buffer_size,
+                            camera_info=camera_info,
                         )
-                        per_camera.append(res)
                     except ToolError as exc:
-                        per_camera.append({"did": did, "channel": ch, "status": "error", "error": str(exc)})
-                results[did] = per_camera
+                        res = {"did": did, "channel": ch, "status": "error", "error": str(exc)}
+                    return did, res
+
+            tasks = []
+            results: dict[str, list] = {}
+            for did, camera_info in cameras.items():
+                results[did] = []
+                max_channels = camera_info.channel_count or 1
+                channels = range(max_channels) if all_channels else [channel]
+                for ch in channels:
+                    if ch < 0 or ch >= max_channels:
+                        continue
+                    tasks.append(_guarded_start(did, ch, camera_info))
+            for did, res in await asyncio.gather(*tasks):
+                results[did].append(res)
             return {"status": "started_all", "results": results}
 
         async def stop_camera_cache(
             did: str,
             channel: int = 0,
         ) -> dict:
+            nonlocal cameras_cache
+            cameras_cache = None
             cache_key = (did, channel)
-            if cache_key not in camera_cache:
-                return {"did": did, "channel": channel, "status": "not_running"}
-
-            camera_cache.pop(cache_key, None)
-            camera_cache_events.pop(cache_key, None)
-
-            state = camera_instances.get(did)
-            if state and channel in state["channels"]:
-                reg_id = state["reg_ids"].pop(channel, 0)
-                await state["instance"].unregister_decode_jpg_async(channel=channel, reg_id=reg_id)
-                state["channels"].discard(channel)
-                if not state["channels"]:
-                    await state["instance"].stop_async()
-                    state["started"] = False
+            async with channel_locks.setdefault(cache_key, asyncio.Lock()):
+                if camera_cache.pop(cache_key, None) is None:
+                    return {"did": did, "channel": channel, "status": "not_running"}
+
+                camera_cache_conds.pop(cache_key, None)
+
+                state = camera_instances.get(did)
+                if state and channel in state["channels"]:
+                    reg_id = state["reg_ids"].pop(channel, 0)
+                    await state["instance"].unregister_decode_jpg_async(channel=channel, reg_id=reg_id)
+                    state["channels"].discard(channel)
+                    if not state["channels"]:
+                        await state["instance"].stop_async()
+                        state["started"] = False
 
             return {"did": did, "channel": channel, "status": "stopped"}
 
@@ -684,36 +1057,34 @@ async def run_server(
             return_base64: bool = False,
         ) -> dict:
             cache_key = (did, channel)
-            if cache_key not in camera_cache:
+            if (cache := camera_cache.get(cache_key)) is None:
                 raise ToolError("camera cache not started")
 
-            cache = camera_cache[cache_key]
-            event = camera_cache_events[cache_key]
+            cond = camera_cache_conds[cache_key]
             now = time.time()
             updated_at = cache.get("updated_at")
             stale = updated_at is None or (now - updated_at) > max_age
             if stale and wait_timeout > 0:
                 try:
-                    await asyncio.wait_for(event.wait(), timeout=wait_timeout)
+                    await _wait_for_frame(cache, cond, wait_timeout)
                 except asyncio.TimeoutError as exc:
                     raise ToolError("cache wait timeout") from exc
 
-            if not cache["frames"]:
+            latest = _ring_latest(cache["ring"])
+            if latest is None:
                 raise ToolError("snapshot cache empty")
-            data, ts, _ = cache["frames"][-1]
+            data, ts = latest
 
             if return_base64:
                 return {
                     "did": did,
                     "channel": channel,
                     "timestamp": ts,
-                    "base64": base64.b64encode(data).decode("utf-8"),
+                    "base64": await _b64_async(data),
                 }
 
-            snapshot_dir = Path(camera_snapshot_dir).expanduser()
-            snapshot_dir.mkdir(parents=True, exist_ok=True)
             file_path = snapshot_dir / f"camera_{did}_{channel}_{ts}.jpg"
-            file_path.write_bytes(data)
+            await _write_jpg(file_path, data)
             return {
                 "did": did,
                 "channel": channel,
@@ -732,35 +1103,38 @@ async def run_server(
             count = min(count, 50)
 
             cache_key = (did, channel)
-            if cache_key not in camera_cache:
+            if (cache := camera_cache.get(cache_key)) is None:
                 raise ToolError("camera cache not started")
 
-            cache = camera_cache[cache_key]
-            frames = list(cache["frames"])[-count:]
+            frames = _ring_last_n(cache["ring"], count)
             if not frames:
                 raise ToolError("snapshot cache empty")
 
             if return_base64:
+                # Up to 50 frames of base64 is serious CPU; keep it off
+                # the event loop.
+                encoded = await asyncio.to_thread(
+                    lambda: [{"timestamp": ts, "base64": _b64(data)} for data, ts in frames]
+                )
                 return {
                     "did": did,
                     "channel": channel,
                     "count": len(frames),
-                    "frames": [
-                        {
-                            "timestamp": ts,
-                            "base64": base64.b64encode(data).decode("utf-8"),
-                        }
-                        for data, ts, _ in frames
-                    ],
+                    "frames": encoded,
                 }
 
-            snapshot_dir = Path(camera_snapshot_dir).expanduser()
-            snapshot_dir.mkdir(parents=True, exist_ok=True)
-            out_paths = []
-            for data, ts, _ in frames:
-                file_path = snapshot_dir / f"camera_{did}_{channel}_{ts}.jpg"
-                file_path.write_bytes(data)
-                out_paths.append({"timestamp": ts, "file_path": str(file_path)})
+            out_paths = [
+                {
+                    "timestamp": ts,
+                    "file_path": str(snapshot_dir / f"camera_{did}_{channel}_{ts}.jpg"),
+                }
+                for _, ts in frames
+            ]
+            await asyncio.to_thread(
+                _write_jpgs_batch,
+                snapshot_dir,
+                [(f"camera_{did}_{channel}_{ts}.jpg", data) for data, ts in frames],
+            )
             return {"did": did, "channel": channel, "count": len(out_paths), "frames": out_paths}
 
         mcp_server.tool(
@@ -785,16 +1159,18 @@ async def run_server(
         )(get_cached_camera_frames)
 
         async def _auto_start_all_cameras() -> None:
+            # Exponential backoff: a fast-failing start (no auth yet, no
+            # cameras) shouldn't spin the loop every few seconds forever.
+            delay = 5.0
             while True:
                 try:
                     await start_all_camera_cache(channel=0, buffer_size=30, all_channels=False)
                     return
-                except ToolError:
-                    await asyncio.sleep(5)
                 except Exception:
-                    await asyncio.sleep(5)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 300.0)
 
-        asyncio.create_task(_auto_start_all_cameras())
+        auto_start_task = asyncio.create_task(_auto_start_all_cameras())
 
         @mcp_server.custom_route("/health", ["GET"], include_in_schema=False)
         async def _health(_request):
@@ -806,96 +1182,102 @@ async def run_server(
 
         @mcp_server.custom_route("/", ["GET"], include_in_schema=False)
         async def _root(_request):
-            body = (
-                "<html><body>"
-                "<h3>Mini Miloco MCP HTTP</h3>"
-                "<ul>"
-                f"<li><a href='/health'>/health</a></li>"
-                f"<li><a href='/version'>/version</a></li>"
-                f"<li><a href='/auth'>/auth</a></li>"
-                "</ul>"
-                "</body></html>"
-            )
-            return HTMLResponse(body)
-
-        @mcp_server.custom_route("/auth", ["GET"], include_in_schema=False)
-        async def _auth_page(_request):
-            nonlocal pending_auth_url, pending_auth_state, pending_auth_uuid, pending_auth_redirect, pending_auth_cloud
-            auth_client = None
-            try:
-                redirect = payload.get("redirect_uri") if payload else redirect_uri
-                cloud = payload.get("cloud_server") if payload else cloud_server
-                device_uuid = (payload.get("uuid") if payload else None) or uuid or uuid4().hex
+            return HTMLResponse(_ROOT_HTML)
+
+        def _resolve_auth_config() -> tuple[str, str, str]:
+            # (redirect, cloud, uuid) resolved once per payload
+            # generation; the uuid4 fallback in particular must stay
+            # stable across /auth page reloads within one flow.
+            nonlocal resolved_auth
+            if resolved_auth is None:
+                resolved_auth = (
+                    (payload.get("redirect_uri") if payload else None) or redirect_uri,
+                    (payload.get("cloud_server") if payload else None) or cloud_server,
+                    (payload.get("uuid") if payload else None) or uuid or uuid4().hex,
+                )
+            return resolved_auth
+
+        async def _drop_auth_client() -> None:
+            nonlocal auth_client, auth_client_cfg
+            if auth_client is not None:
+                old = auth_client
+                auth_client = None
+                auth_client_cfg = None
+                await old.deinit_async()
+
+        async def _get_auth_client(redirect: str, cloud: str, device_uuid: str):
+            # One client serves the whole login flow; rebuilding it per
+            # page hit cost a construct/deinit pair on every reload.
+            nonlocal auth_client, auth_client_cfg, auth_client_created_at
+            cfg = (redirect, cloud, device_uuid)
+            if auth_client is not None and (
+                auth_client_cfg != cfg or time.time() - auth_client_created_at > AUTH_CLIENT_TTL
+            ):
+                await _drop_auth_client()
+            if auth_client is None:
                 auth_client = MIoTOAuth2Client(
                     redirect_uri=redirect,
                     cloud_server=cloud,
                     uuid=device_uuid,
                 )
-                pending_auth_url = auth_client.gen_auth_url(skip_confirm=False)
-                pending_auth_state = auth_client.state
-                pending_auth_uuid = device_uuid
-                pending_auth_redirect = redirect
-                pending_auth_cloud = cloud
-            finally:
-                if auth_client:
-                    await auth_client.deinit_async()
-            body = f"""
-            <html>
-              <body>
-                <h3>Mini Miloco Authorization</h3>
-                <p>1) Open this URL and complete login:</p>
-                <p><a href="{pending_auth_url}" target="_blank">{pending_auth_url}</a></p>
-                <p>2) Paste the final redirect URL below:</p>
-                <form method="get" action="/auth/callback">
-                  <input type="text" name="url" style="width: 90%;" />
-                  <button type="submit">Submit</button>
-                </form>
-              </body>
-            </html>
-            """
-            return HTMLResponse(body)
+                auth_client_cfg = cfg
+                auth_client_created_at = time.time()
+            return auth_client
+
+        @mcp_server.custom_route("/auth", ["GET"], include_in_schema=False)
+        async def _auth_page(_request):
+            redirect, cloud, device_uuid = _resolve_auth_config()
+            oauth = await _get_auth_client(redirect, cloud, device_uuid)
+            pending_auth.url = oauth.gen_auth_url(skip_confirm=False)
+            pending_auth.state = oauth.state
+            pending_auth.uuid = device_uuid
+            pending_auth.redirect = redirect
+            pending_auth.cloud = cloud
+            url_esc = html.escape(pending_auth.url, quote=True)
+            return HTMLResponse(_AUTH_HTML_PREFIX + url_esc + _AUTH_HTML_MID + url_esc + _AUTH_HTML_SUFFIX)
 
         @mcp_server.custom_route("/auth/callback", ["GET"], include_in_schema=False)
         async def _auth_callback(request):
-            nonlocal pending_auth_url, payload, pending_auth_state, pending_auth_uuid, pending_auth_redirect, pending_auth_cloud
+            nonlocal payload, resolved_auth
             url = request.query_params.get("url")
             if not url:
                 return PlainTextResponse("Missing ?url= param", status_code=400)
+            # A URL without code= can't yield a code; reject it before
+            # paying for the parse. Anything non-URL falls through, since
+            # the parser treats it as a bare pasted code.
+            if "code=" not in url and "://" in url:
+                return PlainTextResponse("No code found in url", status_code=400)
 
             code, state = _parse_code_state(url)
             if not code:
                 return PlainTextResponse("No code found in url", status_code=400)
 
-            device_uuid = pending_auth_uuid or (payload.get("uuid") if payload else None) or uuid or uuid4().hex
-            redirect = pending_auth_redirect or (payload.get("redirect_uri") if payload else redirect_uri)
-            cloud = pending_auth_cloud or (payload.get("cloud_server") if payload else cloud_server)
-            auth_client = MIoTOAuth2Client(
-                redirect_uri=redirect,
-                cloud_server=cloud,
-                uuid=device_uuid,
-            )
-            try:
-                expected_state = pending_auth_state or auth_client.state
-                if state and state != expected_state:
-                    return PlainTextResponse("OAuth state mismatch", status_code=400)
-                oauth_info = await auth_client.get_access_token_async(code=code)
-                payload = {
-                    "uuid": device_uuid,
-                    "cloud_server": cloud,
-                    "redirect_uri": redirect,
-                    "oauth_info": oauth_info.model_dump(exclude_none=True),
-                    "saved_at": int(time.time()),
-                }
-                token_path.parent.mkdir(parents=True, exist_ok=True)
-                token_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-                pending_auth_url = None
-                pending_auth_state = None
-                pending_auth_uuid = None
-                pending_auth_redirect = None
-                pending_auth_cloud = None
-                return PlainTextResponse("Authorization saved. You can retry your request.")
-            finally:
-                await auth_client.deinit_async()
+            if pending_auth.uuid:
+                device_uuid = pending_auth.uuid
+                redirect = pending_auth.redirect
+                cloud = pending_auth.cloud
+            else:
+                redirect, cloud, device_uuid = _resolve_auth_config()
+            oauth = await _get_auth_client(redirect, cloud, device_uuid)
+            expected_state = pending_auth.state or oauth.state
+            if state and state != expected_state:
+                return PlainTextResponse("OAuth state mismatch", status_code=400)
+            # Keep the client alive on failure so a corrected paste can
+            # retry without rebuilding it; drop it once the flow is done.
+            oauth_info = await oauth.get_access_token_async(code=code)
+            payload = {
+                "uuid": device_uuid,
+                "cloud_server": cloud,
+                "redirect_uri": redirect,
+                "oauth_info": oauth_info.model_dump(exclude_none=True),
+                "saved_at": int(time.time()),
+            }
+            token_path.parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(_atomic_write_json, token_path, payload)
+            resolved_auth = None
+            pending_auth.reset()
+            await _drop_auth_client()
+            return PlainTextResponse("Authorization saved. You can retry your request.")
 
         await mcp_server.run_http_async(
             transport=transport,
@@ -905,5 +1287,13 @@ async def run_server(
         )
         return 0
     finally:
+        if auto_start_task is not None:
+            auto_start_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await auto_start_task
+        if token_refresher_task is not None:
+            token_refresher_task.cancel()
+        if auth_client is not None:
+            await auth_client.deinit_async()
         if client:
             await client.deinit_async()
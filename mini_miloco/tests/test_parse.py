@@ -0,0 +1,34 @@
+from mini_miloco.auth import _parse_code_state
+
+
+def test_empty() -> None:
+    assert _parse_code_state("") == (None, None)
+    assert _parse_code_state("   ") == (None, None)
+
+
+def test_raw_code() -> None:
+    assert _parse_code_state("ABC123") == ("ABC123", None)
+
+
+def test_full_url() -> None:
+    url = "https://mico.api.mijia.tech/login_redirect?code=XYZ&state=st1"
+    assert _parse_code_state(url) == ("XYZ", "st1")
+
+
+def test_url_without_state() -> None:
+    url = "https://example.com/cb?code=XYZ"
+    assert _parse_code_state(url) == ("XYZ", None)
+
+
+def test_bare_query_string() -> None:
+    assert _parse_code_state("code=XYZ&state=st1") == ("XYZ", "st1")
+
+
+def test_percent_encoded_value() -> None:
+    url = "https://example.com/cb?code=a%2Fb&state=s%20t"
+    assert _parse_code_state(url) == ("a/b", "s t")
+
+
+def test_url_with_fragment() -> None:
+    url = "https://example.com/cb?code=XYZ&state=st1#frag"
+    assert _parse_code_state(url) == ("XYZ", "st1")